@@ -981,6 +981,9 @@ class MPC(do_mpc.optimizer.Optimizer, do_mpc.model.IteratedVariables):
         self.opt_x_num_unscaled = self.opt_x(0)
         self.opt_p_num = self.opt_p(0)
         self.opt_aux_num = self.opt_aux(0)
+        # Lagrange multipliers (all zero) as initial guess for the solver:
+        self.lam_x_num = DM.zeros(self.n_opt_x)
+        self.lam_g_num = DM.zeros(self.n_opt_lagr)
 
         # Create function to caculate all auxiliary expressions:
         self.opt_aux_expression_fun = Function('opt_aux_expression_fun', [opt_x, opt_p], [opt_aux])
@@ -24,13 +24,39 @@ import numpy as np
 from casadi import *
 from casadi.tools import *
 import pdb
-import copy
 import warnings
+import os
+import hashlib
+import shutil
+import subprocess
+import tempfile
 
 import do_mpc.optimizer
 import do_mpc.data
 
 
+def _pad_meas(y_hist, n_horizon):
+    """Private helper for the default measurement function of the :py:class:`MHE`.
+    Returns the last ``n_horizon`` measurements of ``y_hist`` (oldest first).
+    If fewer measurements are available, the sequence is padded with the oldest available measurement.
+    If no measurements are available, all values are zero.
+
+    :param y_hist: History of measurements with shape ``(n_steps, n_y)``.
+    :type y_hist: numpy.ndarray
+    :param n_horizon: Horizon of the MHE.
+    :type n_horizon: int
+
+    :return: Measurements for the horizon with shape ``(n_horizon, n_y)``.
+    :rtype: numpy.ndarray
+    """
+    n_steps = min(y_hist.shape[0], n_horizon)
+    if n_steps == 0:
+        return np.zeros((n_horizon, y_hist.shape[1]))
+    y_hist = y_hist[-n_steps:]
+    y_pad = np.repeat(y_hist[:1], n_horizon-n_steps, axis=0)
+    return np.vstack((y_pad, y_hist))
+
+
 class Estimator(do_mpc.model.IteratedVariables):
     """The Estimator base class. Used for :py:class:`StateFeedback`, :py:class:`EKF` and :py:class:`MHE`.
     This class cannot be used independently.
@@ -175,6 +201,9 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         self._opt_x_num = None
         # Initialize structure to hold the parameters for the optimization problem:
         self._opt_p_num = None
+        # Cached output of tvp_fun and p_fun (only used if these functions are time-invariant):
+        self._tvp_cache = None
+        self._p_set_cache = None
 
         # Parameters that can be set for the MHE:
         self.data_fields = [
@@ -188,7 +217,10 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
             'store_full_solution',
             'store_lagr_multiplier',
             'store_solver_stats',
-            'nlpsol_opts'
+            'nlpsol_opts',
+            'compile_nlp',
+            'compile_path',
+            'compiler',
         ]
 
         # Default Parameters:
@@ -205,6 +237,9 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
             't_wall_S',
         ]
         self.nlpsol_opts = {} # Will update default options with this dict.
+        self.compile_nlp = False
+        self.compile_path = './compiled/'
+        self.compiler = 'gcc'
 
 
         # Create seperate structs for the estimated and the set parameters (the union of both are all parameters of the model.)
@@ -239,10 +274,11 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         # the MHE objective function.
         self._y_meas = self.model._y
 
-        self._x_prev = copy.copy(self.model._x)
+        # The previous estimates are independent symbolic variables with the same structure (and names) as the estimated variables:
+        self._x_prev = struct_symSX(self.model._x)
         self._x = self.model._x
 
-        self._p_est_prev = copy.copy(self._p_est)
+        self._p_est_prev = struct_symSX(self._p_est)
         self._p_est = self._p_est
 
         self._w = self.model._w
@@ -399,6 +435,14 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         self._opt_p_num = val
 
 
+    def reset_history(self):
+        """Reset the history of the MHE.
+        All data from the :py:class:`do_mpc.data.Data` instance is removed.
+        The buffered measurements of the default measurement function (see :py:func:`get_y_template`) are discarded.
+        """
+        do_mpc.optimizer.Optimizer.reset_history(self)
+        self._y_n_meas = 0
+
     def set_param(self, **kwargs):
         """Method to set the parameters of the :py:class:`MHE` class. Parameters must be passed as pairs of valid keywords and respective argument.
         For example:
@@ -451,20 +495,55 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         :param store_solver_stats: Choose which solver statistics to store. Must be a list of valid statistics. Defaults to ``['success','t_wall_S','t_wall_S']``.
         :type store_solver_stats: list
 
-        :param nlpsol_opts: Dictionary with options for the CasADi solver call ``nlpsol`` with plugin ``ipopt``. All options are listed `here <http://casadi.sourceforge.net/api/internal/d4/d89/group__nlpsol.html>`_.
+        :param nlpsol_opts: Dictionary with options for the CasADi solver call ``nlpsol`` with plugin ``ipopt``. All options are listed `here <http://casadi.sourceforge.net/api/internal/d4/d89/group__nlpsol.html>`_. The passed options update the defaults ``{'expand': True, 'ipopt.linear_solver': 'mumps'}``.
         :type store_solver_stats: dict
 
+        :param compile_nlp: Generate C code for the functions of the NLP and compile it (with ``compiler``) to a shared library, which is then used by the solver. The library is stored in ``compile_path`` and named after a fingerprint of the problem (model, objective, constraints, scaling and discretization). If a library exists for the problem (e.g. when the script is executed again), the NLP is neither constructed nor compiled but directly loaded from the library. Changing only the bounds does not require a new library. Note that compiling large problems can take minutes and the solver is only faster if the evaluation of the NLP functions (and not e.g. the linear solver) dominates the solve time. JIT options in ``nlpsol_opts`` are ignored in this case. Defaults to ``False``.
+        :type compile_nlp: bool
+
+        :param compile_path: Directory for the generated code and the compiled libraries if ``compile_nlp=True``. Defaults to ``'./compiled/'``.
+        :type compile_path: str
+
+        :param compiler: C compiler that is called (with ``-fPIC -shared -O3``) if ``compile_nlp=True``. Defaults to ``'gcc'``.
+        :type compiler: str
+
         .. note:: We highly suggest to change the linear solver for IPOPT from `mumps` to `MA27`. In many cases this will drastically boost the speed of **do-mpc**. Change the linear solver with:
 
             ::
 
-                optimizer.set_param(nlpsol_opts = {'ipopt.linear_solver': 'MA27'})
+                mhe.set_param(nlpsol_opts = {'ipopt.linear_solver': 'MA27'})
+
+            `MA27` is part of the HSL library, which is not shipped with the default CasADi installation and is therefore not the default.
+
+        .. note:: Consecutive MHE problems are very similar. The solution (including the Lagrange multipliers) of the previous call is always passed
+            as initial guess to the solver. Configure IPOPT to make use of the multipliers with:
+
+            ::
+
+                warmstart_ipopt = {
+                    'ipopt.warm_start_init_point': 'yes',
+                    'ipopt.warm_start_bound_push': 1e-8,
+                    'ipopt.warm_start_mult_bound_push': 1e-8,
+                    'ipopt.mu_init': 1e-6,
+                }
+                mhe.set_param(nlpsol_opts = warmstart_ipopt)
+
+            This typically reduces the number of IPOPT iterations per call significantly.
+
+        .. note:: The NLP functions can be compiled to machine code (requires a C compiler), which speeds up the solver at the expense of a longer setup:
+
+            ::
+
+                mhe.set_param(nlpsol_opts = {'jit': True})
+
+            Unless configured otherwise, the system compiler is called with ``-O3``.
+
         .. note:: To surpress the output of IPOPT, please use:
 
             ::
 
                 surpress_ipopt = {'ipopt.print_level':0, 'ipopt.sb': 'yes', 'print_time':0}
-                optimizer.set_param(nlpsol_opts = surpress_ipopt)
+                mhe.set_param(nlpsol_opts = surpress_ipopt)
 
         """
         assert self.flags['setup'] == False, 'Setting parameters after setup is prohibited.'
@@ -562,14 +641,16 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         assert self.flags['setup'] == False, 'Cannot call .set_objective after .setup.'
 
 
+        # The inputs are purely symbolic, such that their elements are the symbolic variables.
+        # Only the cost expressions must be traversed with symvar (once each).
         stage_cost_input = self._w, self._v, self.model._tvp, self.model._p
         err_msg = 'objective cost equation must be solely depending on w, v, p and tvp.'
-        assert set(symvar(stage_cost)).issubset(set(symvar(vertcat(*stage_cost_input)))), err_msg
+        assert set(symvar(stage_cost)).issubset(set(vertcat(*stage_cost_input).nonzeros())), err_msg
         self.stage_cost_fun = Function('stage_cost_fun', [*stage_cost_input], [stage_cost])
 
         arrival_cost_input = self._x, self._x_prev, self._p_est, self._p_est_prev, self._p_set
         err_msg = 'Arrival cost equation must be solely depending on x_0, x_prev, p_0, p_prev, p_set'
-        assert set(symvar(arrival_cost)).issubset(set(symvar(vertcat(*arrival_cost_input)))), err_msg
+        assert set(symvar(arrival_cost)).issubset(set(vertcat(*arrival_cost_input).nonzeros())), err_msg
         self.arrival_cost_fun = Function('arrival_cost_fun', arrival_cost_input, [arrival_cost])
 
         self.flags['set_objective'] = True
@@ -746,24 +827,10 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         .. note::
             The structure is ordered, sucht that ``k=0`` is the "oldest measurement" and ``k=N_horizon`` is the newest measurement.
 
-        By default, the following measurement function is choosen:
-
-        ::
-
-            y_template = self.get_y_template()
-
-            def y_fun(t_now):
-                n_steps = min(self.data._y.shape[0], self.n_horizon)
-                for k in range(-n_steps,0):
-                    y_template['y_meas',k] = self.data._y[k]
-                try:
-                    for k in range(self.n_horizon-n_steps):
-                        y_template['y_meas',k] = self.data._y[-n_steps]
-                except:
-                    None
-                return y_template
-
-        Which simply reads the last results from the ``MHE.data`` object.
+        By default (with ``meas_from_data=True``), the measurement function simply reads the last ``n_horizon`` measurements
+        from the ``MHE.data`` object.
+        If fewer measurements than ``n_horizon`` are available, the sequence is padded with the oldest measurement.
+        Internally, the measurements are stored in a ring buffer, such that only the newest measurement is written at each step.
 
         :return: y_template
         :rtype: struct_symSX
@@ -812,31 +879,47 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
                 raise Exception('Your bounds are inconsistent. For {} you have lower bound > upper bound.'.format(bound_fail))
 
         # Set dummy functions for tvp and p in case these parameters are unused.
+        # These functions are marked as constant, such that they are only evaluated once in make_step.
         if 'tvp_fun' not in self.__dict__:
             _tvp = self.get_tvp_template()
 
             def tvp_fun(t): return _tvp
+            tvp_fun._is_const = True
             self.set_tvp_fun(tvp_fun)
 
         if 'p_fun' not in self.__dict__:
             _p = self.get_p_template()
 
             def p_fun(t): return _p
+            p_fun._is_const = True
             self.set_p_fun(p_fun)
 
         if self.flags['set_y_fun'] == False and self.meas_from_data:
             # Case that measurement function is automatically created.
             y_template = self.get_y_template()
 
+            # Ring buffer for the measurements of the horizon. The oldest measurement is stored at index _y_head.
+            self._y_buffer = np.zeros((self.n_horizon, self.model.n_y))
+            self._y_head = 0
+            self._y_n_meas = 0
+            # Cached index permutations to obtain the ordered measurements for each position of _y_head:
+            self._y_order = [np.roll(np.arange(self.n_horizon), -k) for k in range(self.n_horizon)]
+
             def y_fun(t_now):
-                n_steps = min(self.data._y.shape[0], self.n_horizon)
-                for k in range(-n_steps,0):
-                    y_template['y_meas',k] = self.data._y[k]
-                try:
-                    for k in range(self.n_horizon-n_steps):
-                        y_template['y_meas',k] = self.data._y[-n_steps]
-                except:
-                    None
+                n_meas = self.data._y.shape[0]
+                if n_meas == self._y_n_meas + 1 and self._y_n_meas > 0:
+                    # Single new measurement: Overwrite the oldest measurement.
+                    self._y_buffer[self._y_head] = self.data._y[-1]
+                    self._y_head = (self._y_head + 1) % self.n_horizon
+                else:
+                    # First measurement or modified history (e.g. after reset_history): Rebuild the buffer.
+                    self._y_buffer = _pad_meas(self.data._y, self.n_horizon)
+                    self._y_head = 0
+                self._y_n_meas = n_meas
+
+                y_meas = self._y_buffer[self._y_order[self._y_head]]
+                # The structure only holds y_meas (ordered by time step), such that all values are set at once:
+                y_template.master = DM(y_meas.reshape(-1,1))
                 return y_template
             self.set_y_fun(y_fun)
         elif self.flags['set_y_fun'] == True:
@@ -861,10 +944,10 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         """
         assert self.flags['setup'] == True, 'mhe was not setup yet. Please call mhe.setup().'
 
-        self.opt_x_num['_x'] = self._x0.cat/self._x_scaling
-        self.opt_x_num['_u'] = self._u0.cat/self._u_scaling
-        self.opt_x_num['_z'] = self._z0.cat/self._z_scaling
-        self.opt_x_num['_p_est'] = self._p_est0.cat/self._p_est_scaling
+        self.opt_x_num['_x'] = self._x0.cat*self._x_scaling_inv
+        self.opt_x_num['_u'] = self._u0.cat*self._u_scaling_inv
+        self.opt_x_num['_z'] = self._z0.cat*self._z_scaling_inv
+        self.opt_x_num['_p_est'] = self._p_est0.cat*self._p_est_scaling_inv
 
         self.flags['set_initial_guess'] = True
 
@@ -930,57 +1013,63 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
             # Since do-mpc is warmstarting, the initial guess will exist after the first call.
             self.flags['set_initial_guess'] = True
 
-        self.data.update(_y = y0)
+        # Bind frequently accessed attributes (some of them are properties) to local variables:
+        data = self.data
+        opt_x_num = self.opt_x_num
+        opt_p_num = self.opt_p_num
+
+        data.update(_y = y0)
 
 
         p_est0 = self._p_est0
         x0 = self._x0
 
         t0 = self._t0
-        tvp0 = self.tvp_fun(t0)
-        p_set0 = self.p_fun(t0)
+        # Functions marked as constant (see _check_validity) are only evaluated once:
+        if self._tvp_cache is None or not getattr(self.tvp_fun, '_is_const', False):
+            self._tvp_cache = self.tvp_fun(t0)
+        if self._p_set_cache is None or not getattr(self.p_fun, '_is_const', False):
+            self._p_set_cache = self.p_fun(t0)
+        tvp0 = self._tvp_cache
+        p_set0 = self._p_set_cache
 
         y_traj = self.y_fun(t0)
 
-        self.opt_p_num['_x_prev'] = self.opt_x_num['_x', 1, -1]*self._x_scaling
-        self.opt_p_num['_p_est_prev'] = p_est0
-        self.opt_p_num['_p_set'] = p_set0
-        self.opt_p_num['_tvp'] = tvp0['_tvp']
-        self.opt_p_num['_y_meas'] = y_traj['y_meas']
+        opt_p_num['_x_prev'] = opt_x_num['_x', 1, -1]*self._x_scaling
+        opt_p_num['_p_est_prev'] = p_est0
+        opt_p_num['_p_set'] = p_set0
+        opt_p_num['_tvp'] = tvp0['_tvp']
+        opt_p_num['_y_meas'] = y_traj['y_meas']
 
         self.solve()
 
         # Extract solution:
-        x_next = self.opt_x_num['_x', -1, -1]*self._x_scaling
-        p_est_next = self.opt_x_num['_p_est']*self._p_est_scaling
-        u0 = self.opt_x_num['_u', -1]*self._u_scaling
-        z0  = self.opt_x_num['_z', -1, -1]*self._z_scaling
+        x_next, p_est_next, u0, z0, p0 = self._extract_fun(opt_x_num, opt_p_num)
         aux0 = self.opt_aux_num['_aux', -1]
-        p0 = self._p_cat_fun(p_est0, p_set0)
-
-        # Update data object:
-        self.data.update(_x = x0)
-        self.data.update(_u = u0)
-        self.data.update(_z = z0)
-        self.data.update(_p = p0)
-        self.data.update(_tvp = tvp0['_tvp', -1])
-        self.data.update(_time = t0)
-        self.data.update(_aux = aux0)
-
-        # Store additional information
-        self.data.update(opt_p_num = self.opt_p_num)
+
+        # Collect all results and update the data object with a single call:
+        data_update = {
+            '_x': x0,
+            '_u': u0,
+            '_z': z0,
+            '_p': p0,
+            '_tvp': tvp0['_tvp', -1],
+            '_time': t0,
+            '_aux': aux0,
+            # Store additional information
+            'opt_p_num': opt_p_num,
+        }
         if self.store_full_solution == True:
-            opt_x_num_unscaled = self.opt_x_num_unscaled
-            opt_aux_num = self.opt_aux_num
-            self.data.update(_opt_x_num = opt_x_num_unscaled)
-            self.data.update(_opt_aux_num = opt_aux_num)
+            data_update['_opt_x_num'] = self.opt_x_num_unscaled
+            data_update['_opt_aux_num'] = self.opt_aux_num
         if self.store_lagr_multiplier == True:
-            lam_g_num = self.lam_g_num
-            self.data.update(_lam_g_num = lam_g_num)
+            data_update['_lam_g_num'] = self.lam_g_num
         if len(self.store_solver_stats) > 0:
             solver_stats = self.solver_stats
             store_solver_stats = self.store_solver_stats
-            self.data.update(**{stat_i: value for stat_i, value in solver_stats.items() if stat_i in store_solver_stats})
+            data_update.update({stat_i: value for stat_i, value in solver_stats.items() if stat_i in store_solver_stats})
+
+        data.update(**data_update)
 
         # Update initial
         self._t0 = self._t0 + self.t_step
@@ -991,6 +1080,87 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
 
         return x_next.full()
 
+    def _get_nlp_fingerprint(self, ifcn, nlpsol_opts):
+        """Private method of the MHE class to identify the NLP without constructing it.
+        The NLP is fully determined by the discretization (``ifcn``), the functions of the model, objective and constraints,
+        the estimated parameters and the scaling. The returned fingerprint is a hash of these.
+
+        :param ifcn: Integrator function obtained from :py:func:`do_mpc.optimizer.Optimizer._setup_discretization`.
+        :type ifcn: casadi.Function
+        :param nlpsol_opts: Options for the solver (``nlpsol``).
+        :type nlpsol_opts: dict
+
+        :return: Fingerprint of the NLP
+        :rtype: str
+        """
+        nlp_funs = [
+            ifcn,
+            self.model._meas_fun,
+            self.model._aux_expression_fun,
+            self._nl_cons_fun,
+            self.stage_cost_fun,
+            self.arrival_cost_fun,
+            self.epsterm_fun,
+        ]
+        nlp_props = [
+            CasadiMeta.version(),
+            self.n_horizon,
+            self.model._p.keys(),
+            self._p_est.keys(),
+            self._x_scaling.cat.full().tolist(),
+            self._u_scaling.cat.full().tolist(),
+            self._z_scaling.cat.full().tolist(),
+            self._p_est_scaling.cat.full().tolist(),
+            nlpsol_opts.get('expand'),
+        ]
+        nlp_desc = [nlp_fun.serialize() for nlp_fun in nlp_funs] + [repr(nlp_props)]
+
+        return hashlib.sha1('\n'.join(nlp_desc).encode()).hexdigest()[:16]
+
+    def _compile_nlp(self, nlp, nlpsol_opts, lib_name):
+        """Private method of the MHE class to compile the NLP ahead of time.
+        Generates C code for all functions of the solver for ``nlp`` (and the function of the auxiliary expressions)
+        and compiles it with ``compiler`` to the shared library ``lib_name.so``.
+
+        :param nlp: The NLP with the keys ``x``, ``f``, ``g`` and ``p``.
+        :type nlp: dict
+        :param nlpsol_opts: Options for the solver (``nlpsol``). Options for JIT compilation are ignored,
+            expansion only applies to the generated code.
+        :type nlpsol_opts: dict
+        :param lib_name: Path of the generated code and the library (without extension).
+        :type lib_name: str
+
+        :return: None
+        :rtype: None
+        """
+        assert shutil.which(self.compiler) is not None, 'The compiler {} for compile_nlp=True was not found. Install it or choose another compiler with set_param(compiler=...).'.format(self.compiler)
+
+        if not os.path.exists(self.compile_path):
+            os.makedirs(self.compile_path)
+
+        # JIT compiled functions cannot be code generated (the generated code would only call the compiled functions).
+        jit_opts = ['jit', 'compiler', 'jit_options']
+        S = nlpsol('S', 'ipopt', nlp, {key: value for key, value in nlpsol_opts.items() if key not in jit_opts})
+
+        # The library must contain the NLP itself (oracle) as well as all its derivatives:
+        code_gen = CodeGenerator('mhe_nlp.c')
+        code_gen.add(S.oracle())
+        for fun_name in S.get_function():
+            code_gen.add(S.get_function(fun_name))
+        code_gen.add(Function('opt_aux_expression_fun', [self.opt_x, self.opt_p], [self.opt_aux]))
+
+        with open(lib_name+'.c', 'w') as f:
+            f.write(code_gen.dump())
+        # Compile to a temporary file first, such that an incomplete library is never used:
+        lib_fd, lib_tmp = tempfile.mkstemp(suffix='.so', dir=self.compile_path)
+        os.close(lib_fd)
+        try:
+            subprocess.run([self.compiler, '-fPIC', '-shared', '-O3', lib_name+'.c', '-o', lib_tmp], check=True)
+            os.replace(lib_tmp, lib_name+'.so')
+        finally:
+            if os.path.isfile(lib_tmp):
+                os.remove(lib_tmp)
+
     def _setup_mhe_optim_problem(self):
         """Private method of the MHE class to construct the MHE optimization problem.
         The method depends on inherited methods from the :py:class:`do_mpc.optimizer.Optimizer`,
@@ -1001,6 +1171,13 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         """
         # Obtain an integrator (collocation, discrete-time) and the amount of intermediate (collocation) points
         ifcn, n_total_coll_points = self._setup_discretization()
+
+        # Reciprocal values of the scaling factors, such that scaling is a multiplication:
+        self._x_scaling_inv = 1/self._x_scaling.cat
+        self._u_scaling_inv = 1/self._u_scaling.cat
+        self._z_scaling_inv = 1/self._z_scaling.cat
+        self._p_est_scaling_inv = 1/self._p_est_scaling.cat
+
         # Create struct for optimization variables:
         self.opt_x = opt_x = struct_symSX([
             entry('_x', repeat=[self.n_horizon+1, 1+n_total_coll_points], struct=self.model._x),
@@ -1049,113 +1226,173 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         self.lb_opt_x = opt_x(-np.inf)
         self.ub_opt_x = opt_x(np.inf)
 
-        # Initialize objective function and constraints
-        obj = 0
-        cons = []
-        cons_lb = []
-        cons_ub = []
-
-        # Arrival cost:
-        arrival_cost = self.arrival_cost_fun(
-            opt_x_unscaled['_x', 0, -1],
-            opt_p['_x_prev'],#/self._x_scaling,
-            opt_x_unscaled['_p_est'],
-            opt_p['_p_est_prev'],#/self._p_est_scaling
-            opt_p['_p_set']
-            )
-
-        obj += arrival_cost
-
-        # Get concatenated parameters vector containing the estimated and fixed parameters (scaled)
-        _p = self._p_cat_fun(self.opt_x['_p_est'], self.opt_p['_p_set']/self._p_set_scaling)
-
-        # For all control intervals
-        for k in range(self.n_horizon):
-            # Compute constraints and predicted next state of the discretization scheme
-            [g_ksb, xf_ksb] = ifcn(opt_x['_x', k, -1], vertcat(*opt_x['_x', k+1, :-1]),
-                                   opt_x['_u', k], vertcat(*opt_x['_z', k, :]), opt_p['_tvp', k],
-                                   _p, opt_x['_w', k])
-
-            # Compute current measurement
-            yk_calc = self.model._meas_fun(opt_x_unscaled['_x', k+1, -1], opt_x_unscaled['_u', k], opt_x_unscaled['_z', k, -1],
-                opt_p['_tvp', k], _p, opt_x_unscaled['_v', k])
-
-            # Add the collocation equations
-            cons.append(g_ksb)
-            cons_lb.append(np.zeros(g_ksb.shape[0]))
-            cons_ub.append(np.zeros(g_ksb.shape[0]))
-
-            # Add continuity constraints
-            cons.append(xf_ksb - opt_x['_x', k+1, -1])
-            cons_lb.append(np.zeros((self.model.n_x, 1)))
-            cons_ub.append(np.zeros((self.model.n_x, 1)))
-
-            # Add measurement constraints
-            cons.append(yk_calc - opt_p['_y_meas', k])
-            cons_lb.append(np.zeros((self.model.n_y, 1)))
-            cons_ub.append(np.zeros((self.model.n_y, 1)))
-
-            # Add nonlinear constraints only on each control step
-            nl_cons_k = self._nl_cons_fun(
-                opt_x_unscaled['_x', k, -1], opt_x_unscaled['_u', k], opt_x_unscaled['_z', k, -1],
-                opt_p['_tvp', k], _p, opt_x_unscaled['_eps', k])
-
-            cons.append(nl_cons_k)
-            cons_lb.append(self._nl_cons_lb)
-            cons_ub.append(self._nl_cons_ub)
-
-
-            obj += self.stage_cost_fun(
-                opt_x_unscaled['_w', k], opt_x_unscaled['_v', k], opt_p['_tvp', k], _p
-            )
-
-            # Add slack variables to the cost
-            obj += self.epsterm_fun(opt_x_unscaled['_eps', k])
-
-
-            # Calculate the auxiliary expressions for the current scenario:
-            opt_aux['_aux', k] = self.model._aux_expression_fun(
-                opt_x_unscaled['_x', k, -1], opt_x_unscaled['_u', k], opt_x_unscaled['_z', k, -1], opt_p['_tvp', k], _p)
-
-            # Bounds for the states on all discretize values along the horizon
-            self.lb_opt_x['_x', k] = self._x_lb.cat/self._x_scaling
-            self.ub_opt_x['_x', k] = self._x_ub.cat/self._x_scaling
-
-            # Bounds for the inputs along the horizon
-            self.lb_opt_x['_u', k] = self._u_lb.cat/self._u_scaling
-            self.ub_opt_x['_u', k] = self._u_ub.cat/self._u_scaling
-
-            # Bounds for the slack variables along the horizon:
-            self.lb_opt_x['_eps', k] = self._eps_lb.cat
-            self.ub_opt_x['_eps', k] = self._eps_ub.cat
-
-        # Bounds for the inputs along the horizon
-        self.lb_opt_x['_p_est'] = self._p_est_lb.cat/self._p_est_scaling
-        self.ub_opt_x['_p_est'] = self._p_est_ub.cat/self._p_est_scaling
-
-        # Bounds for the states at final time:
-        self.lb_opt_x['_x', self.n_horizon] = self._x_lb.cat/self._x_scaling
-        self.ub_opt_x['_x', self.n_horizon] = self._x_ub.cat/self._x_scaling
-
+        # Bounds of the constraints are identical for all k:
+        # Collocation equations, continuity and measurement constraints are equality constraints.
+        n_eq_cons_k = ifcn.size1_out(0) + self.model.n_x + self.model.n_y
+        cons_lb_k = np.concatenate((np.zeros(n_eq_cons_k), self._nl_cons_lb.cat.full().ravel()))
+        cons_ub_k = np.concatenate((np.zeros(n_eq_cons_k), self._nl_cons_ub.cat.full().ravel()))
+        self.cons_lb = DM(np.tile(cons_lb_k, self.n_horizon))
+        self.cons_ub = DM(np.tile(cons_ub_k, self.n_horizon))
+        self.n_opt_lagr = self.cons_lb.shape[0]
+
+        # Bounds for the states (on all discretized values), inputs and slack variables are identical along the horizon.
+        # The bounds are tiled and written at once to the flat indices of the respective entries.
+        var_bounds = [
+            ('_x', self._x_lb.cat*self._x_scaling_inv, self._x_ub.cat*self._x_scaling_inv),
+            ('_u', self._u_lb.cat*self._u_scaling_inv, self._u_ub.cat*self._u_scaling_inv),
+            ('_eps', self._eps_lb.cat, self._eps_ub.cat),
+        ]
+        for var_name, var_lb, var_ub in var_bounds:
+            ind = self.lb_opt_x.f[var_name]
+            if len(ind) > 0:
+                n_rep = len(ind)//var_lb.shape[0]
+                self.lb_opt_x.master[ind] = np.tile(var_lb.full().ravel(), n_rep)
+                self.ub_opt_x.master[ind] = np.tile(var_ub.full().ravel(), n_rep)
 
-        cons = vertcat(*cons)
-        self.cons_lb = vertcat(*cons_lb)
-        self.cons_ub = vertcat(*cons_ub)
+        # Bounds for the estimated parameters:
+        self.lb_opt_x['_p_est'] = self._p_est_lb.cat*self._p_est_scaling_inv
+        self.ub_opt_x['_p_est'] = self._p_est_ub.cat*self._p_est_scaling_inv
 
-        self.n_opt_lagr = cons.shape[0]
         # Create casadi optimization object:
+        # The NLP is formulated entirely with SX symbols and can thus be expanded, which speeds up function evaluations.
+        # Default options are updated (not replaced) with the user supplied options.
         nlpsol_opts = {
-            'expand': False,
+            'expand': True,
             'ipopt.linear_solver': 'mumps',
-        }.update(self.nlpsol_opts)
-        nlp = {'x': vertcat(opt_x), 'f': obj, 'g': cons, 'p': vertcat(opt_p)}
-        self.S = nlpsol('S', 'ipopt', nlp, self.nlpsol_opts)
+        }
+        nlpsol_opts.update(self.nlpsol_opts)
+        # Just-in-time compilation of the NLP functions is optional, since it requires a C compiler.
+        # If it is enabled, use the system compiler with optimization flags, unless configured otherwise.
+        if nlpsol_opts.get('jit', False):
+            nlpsol_opts.setdefault('compiler', 'shell')
+            nlpsol_opts.setdefault('jit_options', {'flags': ['-O3']})
+        if self.compile_nlp:
+            # The library is identified without constructing the NLP, which is only done (and compiled) if necessary.
+            # Ahead of time compilation replaces JIT compilation.
+            lib_name = os.path.join(self.compile_path, 'mhe_nlp_{}'.format(self._get_nlp_fingerprint(ifcn, nlpsol_opts)))
+            if not os.path.isfile(lib_name+'.so'):
+                nlp = self._setup_mhe_nlp(ifcn, n_total_coll_points)
+                self._compile_nlp(nlp, nlpsol_opts, lib_name)
+            # The functions are loaded from the library and can neither be expanded nor JIT compiled:
+            lib_opts = {key: value for key, value in nlpsol_opts.items() if key not in ['expand', 'jit', 'compiler', 'jit_options']}
+            self.S = nlpsol('S', 'ipopt', os.path.abspath(lib_name+'.so'), lib_opts)
+            self.opt_aux_expression_fun = external('opt_aux_expression_fun', os.path.abspath(lib_name+'.so'))
+        else:
+            nlp = self._setup_mhe_nlp(ifcn, n_total_coll_points)
+            self.S = nlpsol('S', 'ipopt', nlp, nlpsol_opts)
+            # Create function to caculate all auxiliary expressions:
+            self.opt_aux_expression_fun = Function('opt_aux_expression_fun', [opt_x, opt_p], [opt_aux])
 
         # Create copies of these structures with numerical values (all zero):
         self.opt_x_num = self.opt_x(0)
         self.opt_x_num_unscaled = self.opt_x(0)
         self.opt_p_num = self.opt_p(0)
         self.opt_aux_num = self.opt_aux(0)
+        # Lagrange multipliers (all zero) as initial guess for the solver:
+        self.lam_x_num = DM.zeros(self.n_opt_x)
+        self.lam_g_num = DM.zeros(self.n_opt_lagr)
+
+        # Create function to extract the current (unscaled) estimates from the solution in a single call:
+        self._extract_fun = Function('extract_fun', [opt_x, opt_p], [
+            opt_x_unscaled['_x', -1, -1],
+            opt_x_unscaled['_p_est'],
+            opt_x_unscaled['_u', -1],
+            opt_x_unscaled['_z', -1, -1],
+            self._p_cat_fun(opt_p['_p_est_prev'], opt_p['_p_set']),
+        ])
+
+    def _setup_mhe_nlp(self, ifcn, n_total_coll_points):
+        """Private method of the MHE class to construct the objective and the constraints of the MHE optimization problem.
+        The expressions are obtained from the structures ``opt_x``, ``opt_p`` and ``opt_aux``, which are created in
+        :py:func:`_setup_mhe_optim_problem`. The auxiliary expressions are assigned to ``opt_aux``.
+
+        :param ifcn: Integrator function obtained from :py:func:`do_mpc.optimizer.Optimizer._setup_discretization`.
+        :type ifcn: casadi.Function
+        :param n_total_coll_points: Number of collocation points of each control interval.
+        :type n_total_coll_points: int
+
+        :return: The NLP with the keys ``x``, ``f``, ``g`` and ``p``.
+        :rtype: dict
+        """
+        opt_x = self.opt_x
+        opt_x_unscaled = self.opt_x_unscaled
+        opt_p = self.opt_p
+        opt_aux = self.opt_aux
+
+        # Arrival cost:
+        arrival_cost = self.arrival_cost_fun(
+            opt_x_unscaled['_x', 0, -1],
+            opt_p['_x_prev'],#/self._x_scaling,
+            opt_x_unscaled['_p_est'],
+            opt_p['_p_est_prev'],#/self._p_est_scaling
+            opt_p['_p_set']
+            )
 
-        # Create function to caculate all auxiliary expressions:
-        self.opt_aux_expression_fun = Function('opt_aux_expression_fun', [opt_x, opt_p], [opt_aux])
+        # Get concatenated parameters vector containing the estimated and fixed parameters (scaled).
+        # The vector is assembled directly from the entries of opt_x and opt_p (obeying the order of the model parameters).
+        _p = struct_SX(self.model._p)
+        for p_i in self._p_est.keys():
+            if p_i != 'default':
+                _p[p_i] = opt_x['_p_est', p_i]
+        for p_i in self._p_set.keys():
+            _p[p_i] = opt_p['_p_set', p_i]/self._p_set_scaling[p_i]
+        _p = _p.cat
+
+        n_horizon = self.n_horizon
+
+        # Stack the variables for all control intervals column-wise (one column for each k).
+        # All functions are mapped over the horizon and evaluated only once with these matrices.
+        # Arguments that are not stacked (e.g. _p) are identical for all k.
+        x_k = horzcat(*opt_x['_x', :n_horizon, -1])
+        x_next = horzcat(*opt_x['_x', 1:, -1])
+        # The collocation points of _x and _z are contiguous for each k and are obtained from their flat indices:
+        x_coll = reshape(opt_x.cat[opt_x.f['_x', 1:, :-1]], n_total_coll_points*self.model.n_x, n_horizon)
+        z_coll = reshape(opt_x.cat[opt_x.f['_z']], (1+n_total_coll_points)*self.model.n_z, n_horizon)
+        u_k = horzcat(*opt_x['_u', :])
+        w_k = horzcat(*opt_x['_w', :])
+
+        x_k_unscaled = horzcat(*opt_x_unscaled['_x', :n_horizon, -1])
+        x_next_unscaled = horzcat(*opt_x_unscaled['_x', 1:, -1])
+        u_k_unscaled = horzcat(*opt_x_unscaled['_u', :])
+        z_k_unscaled = horzcat(*opt_x_unscaled['_z', :, -1])
+        w_k_unscaled = horzcat(*opt_x_unscaled['_w', :])
+        v_k_unscaled = horzcat(*opt_x_unscaled['_v', :])
+        eps_k_unscaled = horzcat(*opt_x_unscaled['_eps', :])
+
+        tvp_k = horzcat(*opt_p['_tvp', :])
+        y_meas_k = horzcat(*opt_p['_y_meas', :])
+
+        # Compute constraints and predicted next state of the discretization scheme.
+        # Note that the predicted state xf_k is not passed on to the next interval (as with mapaccum) but
+        # coupled with the optimization variable x_{k+1} through the continuity constraints below.
+        # This retains the sparse structure of the (multiple shooting) NLP.
+        g_k, xf_k = ifcn.map(n_horizon)(x_k, x_coll, u_k, z_coll, tvp_k, _p, w_k)
+
+        # Compute current measurement
+        y_calc_k = self.model._meas_fun.map(n_horizon)(
+            x_next_unscaled, u_k_unscaled, z_k_unscaled, tvp_k, _p, v_k_unscaled)
+
+        # Nonlinear constraints only on each control step
+        nl_cons_k = self._nl_cons_fun.map(n_horizon)(
+            x_k_unscaled, u_k_unscaled, z_k_unscaled, tvp_k, _p, eps_k_unscaled)
+
+        # Constraints for each k are (in this order): collocation equations, continuity constraints,
+        # measurement constraints and nonlinear constraints.
+        # Vectorizing the matrix (column-wise) retains the order of the constraints for all k.
+        cons = vec(vertcat(g_k, xf_k - x_next, y_calc_k - y_meas_k, nl_cons_k))
+
+        # Stage cost and slack variables for all k:
+        stage_cost_k = self.stage_cost_fun.map(n_horizon)(w_k_unscaled, v_k_unscaled, tvp_k, _p)
+        epsterm_k = self.epsterm_fun.map(n_horizon)(eps_k_unscaled)
+
+        # Objective as a single sum of the arrival cost and all stage costs and slack terms:
+        obj = sum2(horzcat(arrival_cost, stage_cost_k, epsterm_k))
+
+        # Calculate the auxiliary expressions for all k:
+        aux_k = self.model._aux_expression_fun.map(n_horizon)(
+            x_k_unscaled, u_k_unscaled, z_k_unscaled, tvp_k, _p)
+        opt_aux['_aux'] = horzsplit(aux_k)
+
+        assert(cons.shape[0] == self.n_opt_lagr)
+
+        return {'x': vertcat(opt_x), 'f': obj, 'g': cons, 'p': vertcat(opt_p)}
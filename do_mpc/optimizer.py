@@ -505,6 +505,8 @@ class Optimizer:
         The method updates the :py:attr:`opt_p_num` and :py:attr:`opt_x_num` attributes of the class.
         By resetting :py:attr:`opt_x_num` to the current solution, the method implicitly
         enables **warmstarting the optimizer** for the next iteration, since this vector is always used as the initial guess.
+        Similarly, the Lagrange multipliers of the current solution are used as initial guess for the next iteration.
+        These are only considered by IPOPT with the option ``'ipopt.warm_start_init_point': 'yes'``.
 
         .. warning::
 
@@ -519,12 +521,14 @@ class Optimizer:
         """
         assert self.flags['setup'] == True, 'optimizer was not setup yet. Please call optimizer.setup().'
 
-        r = self.S(x0=self.opt_x_num, lbx=self.lb_opt_x, ubx=self.ub_opt_x,  ubg=self.cons_ub, lbg=self.cons_lb, p=self.opt_p_num)
+        r = self.S(x0=self.opt_x_num, lbx=self.lb_opt_x, ubx=self.ub_opt_x,  ubg=self.cons_ub, lbg=self.cons_lb, p=self.opt_p_num,
+                   lam_x0=self.lam_x_num, lam_g0=self.lam_g_num)
         # Note: .master accesses the underlying vector of the structure.
         self.opt_x_num.master = r['x']
         self.opt_x_num_unscaled.master = r['x']*self.opt_x_scaling
         self.opt_g_num = r['g']
-        # Values of lagrange multipliers:
+        # Values of lagrange multipliers (used as initial guess for the next call):
+        self.lam_x_num = r['lam_x']
         self.lam_g_num = r['lam_g']
         self.solver_stats = self.S.stats()
 
@@ -594,9 +598,6 @@ class Optimizer:
             # Coefficients of the continuity equation
             D = np.zeros(deg + 1)
 
-            # Dimensionless time inside one control interval
-            tau = SX.sym("tau")
-
             # All collocation time points
             T = np.zeros((nk, ni, deg + 1))
             for k in range(nk):
@@ -606,19 +607,16 @@ class Optimizer:
 
             # For all collocation points
             for j in range(deg + 1):
-                # Construct Lagrange polynomials to get the polynomial basis at the
-                # collocation point
-                L = 1
-                for r in range(deg + 1):
-                    if r != j:
-                        L *= (tau - tau_root[r]) / (tau_root[j] - tau_root[r])
-                lfcn = Function('lfcn', [tau], [L])
-                D[j] = lfcn(1.0)
+                # Evaluate the Lagrange polynomial of the collocation point (in product form and numerically,
+                # such that only constants enter the integrator) at the end of the finite element
+                others = [r for r in range(deg + 1) if r != j]
+                D[j] = np.prod([(1.0 - tau_root[r]) / (tau_root[j] - tau_root[r]) for r in others])
                 # Evaluate the time derivative of the polynomial at all collocation
                 # points to get the coefficients of the continuity equation
-                tfcn = Function('tfcn', [tau], [tangent(L, tau)])
-                for r in range(deg + 1):
-                    C[j, r] = tfcn(tau_root[r])
+                for r_eval in range(deg + 1):
+                    for m in others:
+                        C[j, r_eval] += np.prod([(tau_root[r_eval] - tau_root[r]) / (tau_root[j] - tau_root[r])
+                                                 for r in others if r != m]) / (tau_root[j] - tau_root[m])
 
             # Define symbolic variables for collocation
             xk0 = SX.sym("xk0", n_x)
@@ -664,9 +662,11 @@ class Optimizer:
                 # For all collocation points
                 for j in range(1, deg + 1):
                     # Get an expression for the state derivative at the coll point
+                    # (vanishing coefficients are skipped)
                     xp_ij = 0
                     for r in range(deg + 1):
-                        xp_ij += C[r, j] * ik_split[i, r]
+                        if C[r, j] != 0:
+                            xp_ij += C[r, j] * ik_split[i, r]
 
                     # Add collocation equations to the NLP
                     f_ij = ffcn(ik_split[i, j], uk, zk, tv_pk, pk, wk)
@@ -675,9 +675,11 @@ class Optimizer:
                     ubgk.append(np.zeros(n_x))  # equality constraints
 
                 # Get an expression for the state at the end of the finite element
+                # (e.g. for Radau collocation this is exactly the last collocation point)
                 xf_i = 0
                 for r in range(deg + 1):
-                    xf_i += D[r] * ik_split[i, r]
+                    if D[r] != 0:
+                        xf_i += D[r] * ik_split[i, r]
 
                 # Add continuity equation to NLP
                 x_next = ik_split[i + 1, 0] if i + 1 < ni else xkf
@@ -0,0 +1,166 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2019 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from casadi import *
+from casadi.tools import *
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+import do_mpc
+sys.path.pop(-1)
+
+
+def get_model(set_b=False):
+    """
+    Simple discrete-time model with a single state that is measured directly.
+    Optionally, the input gain ``b`` is a parameter that is not estimated (and thus requires a ``p_fun``).
+    """
+    model = do_mpc.model.Model('discrete')
+    x = model.set_variable('_x', 'x')
+    u = model.set_variable('_u', 'u')
+    a = model.set_variable('_p', 'a')
+    b = model.set_variable('_p', 'b') if set_b else 1.0
+    model.set_rhs('x', a*x + b*u)
+    model.set_meas('y', x)
+    model.setup()
+
+    return model
+
+
+def get_mhe(model, n_horizon=3, **kwargs):
+    """
+    MHE with the default measurement, tvp and parameter functions (unless set afterwards).
+    """
+    mhe = do_mpc.estimator.MHE(model, ['a'])
+    mhe.set_param(n_horizon=n_horizon, t_step=1.0, meas_from_data=True,
+                  nlpsol_opts={'ipopt.print_level': 0, 'ipopt.sb': 'yes', 'print_time': 0}, **kwargs)
+    mhe.set_default_objective(np.eye(1), np.eye(1), np.eye(1))
+    mhe.bounds['lower', '_p_est', 'a'] = 0.1
+    mhe.bounds['upper', '_p_est', 'a'] = 2.0
+
+    return mhe
+
+
+def get_y_meas(mhe):
+    """
+    Measurements of the horizon (oldest first) that were passed to the solver in the last call.
+    """
+    return np.array(vertcat(*mhe.opt_p_num['_y_meas']).full()).ravel()
+
+
+class TestMHEMeasFromData(unittest.TestCase):
+
+    def test_meas_from_data(self):
+        """
+        The default measurement function must always use the most recent measurements of the history.
+        """
+        model = get_model()
+        mhe = get_mhe(model)
+        mhe.setup()
+        mhe.x0 = np.zeros(1)
+        mhe.p_est0 = 1.0
+        mhe.set_initial_guess()
+
+        # The measurements are padded with the oldest measurement:
+        mhe.make_step(np.array([[5.0]]))
+        self.assertTrue(np.allclose(get_y_meas(mhe), [5, 5, 5]))
+
+        # Resetting the history after a single step must discard the buffered measurement:
+        mhe.reset_history()
+        mhe.make_step(np.array([[1.0]]))
+        self.assertTrue(np.allclose(get_y_meas(mhe), [1, 1, 1]))
+
+        for k in range(2, 6):
+            mhe.make_step(np.array([[float(k)]]))
+        self.assertTrue(np.allclose(get_y_meas(mhe), [3, 4, 5]))
+
+        # Reset after more than n_horizon steps:
+        mhe.reset_history()
+        mhe.make_step(np.array([[7.0]]))
+        mhe.make_step(np.array([[8.0]]))
+        self.assertTrue(np.allclose(get_y_meas(mhe), [7, 7, 8]))
+
+    def test_p_fun(self):
+        """
+        A user supplied (time-varying) parameter function must be called at every step.
+        """
+        model = get_model(set_b=True)
+        mhe = get_mhe(model)
+        p_template = mhe.get_p_template()
+
+        def p_fun(t_now):
+            p_template['b'] = 1.0 + t_now
+            return p_template
+        mhe.set_p_fun(p_fun)
+        mhe.setup()
+        mhe.x0 = np.zeros(1)
+        mhe.p_est0 = 1.0
+        mhe.set_initial_guess()
+
+        for k in range(3):
+            t_now = mhe._t0.item()
+            mhe.make_step(np.array([[1.0]]))
+            self.assertTrue(np.allclose(mhe.opt_p_num['_p_set', 'b'], 1.0 + t_now))
+
+    def run_compile_nlp(self, nlpsol_opts):
+        """
+        Compare the results of the MHE with compiled NLP to the results of the MHE without compilation.
+        The second MHE with compiled NLP must reuse the existing library.
+        """
+        model = get_model()
+        compile_path = tempfile.mkdtemp()
+        try:
+            results = []
+            for compile_nlp in [False, True, True]:
+                mhe = get_mhe(model, compile_nlp=compile_nlp, compile_path=compile_path)
+                mhe.nlpsol_opts.update(nlpsol_opts)
+                mhe.setup()
+                mhe.x0 = np.zeros(1)
+                mhe.p_est0 = 1.0
+                mhe.set_initial_guess()
+                for k in range(4):
+                    mhe.make_step(np.array([[np.sin(k)]]))
+                results.append(np.hstack((mhe.data._x.ravel(), mhe.data._p.ravel(), mhe.data._aux.ravel())))
+            libs = [file_name for file_name in os.listdir(compile_path) if file_name.endswith('.so')]
+        finally:
+            shutil.rmtree(compile_path)
+
+        self.assertEqual(len(libs), 1)
+        self.assertTrue(np.allclose(results[0], results[1]))
+        self.assertTrue(np.allclose(results[0], results[2]))
+
+    @unittest.skipIf(shutil.which('gcc') is None, 'gcc is required to compile the NLP.')
+    def test_compile_nlp(self):
+        self.run_compile_nlp({})
+
+    @unittest.skipIf(shutil.which('gcc') is None, 'gcc is required to compile the NLP.')
+    def test_compile_nlp_jit(self):
+        self.run_compile_nlp({'jit': True})
+
+
+if __name__ == '__main__':
+    unittest.main()